@@ -2,28 +2,48 @@
 
 import argparse
 import codecs
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
 import os
 import re
 import shutil
+import tempfile
 import warnings
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, Generator, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import keyboardlayout as kl
 import keyboardlayout.pygame as klp
-import librosa
 import numpy
 import pygame
+import scipy.fft
 import soundfile
+import soxr
 
 ANCHOR_INDICATOR = " anchor"
-ANCHOR_NOTE_REGEX = re.compile(r"\s[abcdefg]$")
 DESCRIPTION = 'Use your computer keyboard as a "piano"'
-DESCRIPTOR_32BIT = "FLOAT"
-BITS_32BIT = 32
+DTYPE_32BIT = numpy.float32
+# notes are cached and played as 16 bit PCM, half the size of float32 and still
+# more dynamic range than playing a note needs
+DTYPE_16BIT = numpy.int16
+PCM_16BIT_SCALE = 32767
+BITS_16BIT_SIGNED = -16
 AUDIO_ALLOWED_CHANGES_HARDWARE_DETERMINED = 0
+# about 12 ms at 44.1 kHz, low latency while leaving the mixer room to avoid
+# underruns
+AUDIO_BUFFER_SAMPLES = 512
 SOUND_FADE_MILLISECONDS = 50
+WAV_DIGEST_BYTES = 16
+# older versions cached each note as <tone>.wav in the cache root
+OLD_CACHED_NOTE_REGEX = re.compile(r"-?\d+\.wav")
+# librosa resamplers used after the time stretch, the fast one trades a little
+# quality for a much quicker first run
+RES_TYPE = "soxr_hq"
+FAST_RES_TYPE = "soxr_qq"
 CYAN = (0, 255, 255, 255)
 BLACK = (0, 0, 0, 255)
 WHITE = (255, 255, 255, 255)
@@ -61,11 +81,112 @@ def get_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="deletes stored transposed audio files and recalculates them",
     )
+    parser.add_argument(
+        "--buffer",
+        "-b",
+        metavar="SAMPLES",
+        type=int,
+        default=AUDIO_BUFFER_SAMPLES,
+        help="audio buffer size, raise it if playback crackles, lower it for less "
+        "latency (default: {})".format(AUDIO_BUFFER_SAMPLES),
+    )
+    parser.add_argument(
+        "--fast-pitch",
+        "-f",
+        default=False,
+        action="store_true",
+        help="uses a faster, lower quality resampler when transposing notes",
+    )
     parser.add_argument("--verbose", "-v", action="store_true", help="verbose mode")
 
     return parser
 
 
+@functools.lru_cache(maxsize=None)
+def import_librosa():
+    # librosa takes a long time to import and is only needed to transpose notes,
+    # so launches with every note cached never pay for it
+    import librosa
+
+    # scipy's pocketfft keeps a plan cache across calls of the same length, which
+    # every stft/istft in the pitch shifting shares. it is the default from
+    # librosa 0.11 on, where set_fftlib is deprecated, so only older versions
+    # need it set
+    if librosa.get_fftlib() is not scipy.fft:
+        librosa.set_fftlib(scipy.fft)
+    return librosa
+
+
+def pitch_shift_from_stft(
+    stft: numpy.ndarray, sample_rate_hz: int, n_steps: int, length: int, res_type: str
+) -> numpy.ndarray:
+    # same steps as librosa.effects.pitch_shift but starting from a precomputed
+    # stft: time stretch with the phase vocoder then resample back to length
+    librosa = import_librosa()
+    rate = 2.0 ** (-n_steps / 12)
+    stft_stretch = librosa.phase_vocoder(stft, rate=rate)
+    y_stretch = librosa.istft(stft_stretch, length=int(round(length / rate)))
+    y_shift = librosa.resample(
+        y_stretch,
+        orig_sr=float(sample_rate_hz) / rate,
+        target_sr=sample_rate_hz,
+        res_type=res_type,
+    )
+    return librosa.util.fix_length(y_shift, size=length)
+
+
+def to_pcm_16bit(sound: numpy.ndarray) -> numpy.ndarray:
+    # scaling makes a fresh copy, so clipping it in place is safe
+    pcm_sound = sound * PCM_16BIT_SCALE
+    numpy.clip(pcm_sound, -PCM_16BIT_SCALE - 1, PCM_16BIT_SCALE, out=pcm_sound)
+    return pcm_sound.astype(DTYPE_16BIT)
+
+
+def transpose_and_cache(
+    stft: numpy.ndarray,
+    sample_rate_hz: int,
+    length: int,
+    res_type: str,
+    tone: int,
+    cached_path: Path,
+) -> numpy.ndarray:
+    # librosa shifts all channels at once, they are on the first axis
+    sound = pitch_shift_from_stft(stft, sample_rate_hz, tone, length, res_type)
+    if sound.ndim > 1:
+        # the shape must be [length, channels]
+        sound = numpy.ascontiguousarray(sound.T)
+    pcm_sound = to_pcm_16bit(sound)
+    # save next to the cached path then rename, so that an interrupted run never
+    # leaves a partial note behind that later runs would try to load
+    temp_file = tempfile.NamedTemporaryFile(
+        dir=cached_path.parent, suffix=".tmp", delete=False
+    )
+    try:
+        with temp_file:
+            numpy.save(temp_file, pcm_sound)
+        os.replace(temp_file.name, cached_path)
+    except BaseException:
+        os.remove(temp_file.name)
+        raise
+    return pcm_sound
+
+
+# what every pool worker shares to transpose its tones, set once per worker by
+# init_transpose_worker so that the stft is not sent again with every tone
+transpose_worker_args = ()
+
+
+def init_transpose_worker(
+    stft: numpy.ndarray, sample_rate_hz: int, length: int, res_type: str
+):
+    global transpose_worker_args
+    transpose_worker_args = (stft, sample_rate_hz, length, res_type)
+
+
+def transpose_and_cache_in_worker(tone: int, cached_path: Path) -> numpy.ndarray:
+    return transpose_and_cache(*transpose_worker_args, tone, cached_path)
+
+
 def get_or_create_key_sounds(
     wav_path: str,
     sample_rate_hz: int,
@@ -73,47 +194,111 @@ def get_or_create_key_sounds(
     tones: List[int],
     clear_cache: bool,
     keys: List[str],
-) -> Generator[pygame.mixer.Sound, None, None]:
+    res_type: str = RES_TYPE,
+) -> List[numpy.ndarray]:
     sounds = []
-    y, sr = librosa.load(wav_path, sr=sample_rate_hz, mono=channels == 1)
+    # read the file once, its bytes are both decoded and hashed for the cache key
+    wav_bytes = Path(wav_path).read_bytes()
+    y, wav_sample_rate_hz = soundfile.read(io.BytesIO(wav_bytes), dtype=DTYPE_32BIT)
+    if channels == 1 and y.ndim > 1:
+        # play_pianoputer passes the file's own channel count, this only covers
+        # callers asking for mono notes from a multichannel file. downmix before
+        # resampling so that only one channel is resampled
+        y = y.mean(axis=1, dtype=DTYPE_32BIT)
+    if wav_sample_rate_hz != sample_rate_hz:
+        y = soxr.resample(y, wav_sample_rate_hz, sample_rate_hz)
+    # soundfile gives [length, channels] but librosa expects [channels, length],
+    # copy it once so that every channel is contiguous for the stft
+    y = numpy.ascontiguousarray(y.T)
     file_name = os.path.splitext(os.path.basename(wav_path))[0]
     folder_containing_wav = Path(wav_path).parent.absolute()
-    cache_folder_path = Path(folder_containing_wav, file_name)
-    if clear_cache and cache_folder_path.exists():
-        shutil.rmtree(cache_folder_path)
+    cache_root_path = Path(folder_containing_wav, file_name)
+    # one cache folder per output format and resampler so that notes are never
+    # mixed, keyed by the wav contents so that editing the file invalidates it
+    cache_format = "{}-{}-{}-{}".format(
+        sample_rate_hz, channels, res_type, numpy.dtype(DTYPE_16BIT).name
+    )
+    wav_digest = hashlib.blake2b(wav_bytes, digest_size=WAV_DIGEST_BYTES).hexdigest()
+    cache_folder_path = Path(cache_root_path, "{}-{}".format(cache_format, wav_digest))
+    if clear_cache and cache_root_path.exists():
+        shutil.rmtree(cache_root_path)
     if not cache_folder_path.exists():
         print("Generating samples for each key")
-        os.mkdir(cache_folder_path)
-    for i, tone in enumerate(tones):
-        cached_path = Path(cache_folder_path, "{}.wav".format(tone))
-        if Path(cached_path).exists():
-            print("Loading note {} out of {} for {}".format(i + 1, len(tones), keys[i]))
-            sound, sr = librosa.load(cached_path, sr=sample_rate_hz, mono=channels == 1)
-            if channels > 1:
-                # the shape must be [length, 2]
-                sound = numpy.transpose(sound)
-        else:
-            print(
-                "Transposing note {} out of {} for {}".format(
-                    i + 1, len(tones), keys[i]
+        os.makedirs(cache_folder_path)
+    # notes of the same format cached for earlier contents of the wav file are
+    # never loaded again, so only the current ones are kept
+    for stale_folder_path in cache_root_path.glob(cache_format + "-*"):
+        if stale_folder_path != cache_folder_path and stale_folder_path.is_dir():
+            shutil.rmtree(stale_folder_path)
+    # nothing reads the notes cached by older versions anymore, other files are
+    # left alone since they may not be ours
+    for old_cached_path in cache_root_path.glob("*.wav"):
+        if OLD_CACHED_NOTE_REGEX.fullmatch(old_cached_path.name):
+            old_cached_path.unlink()
+    cached_paths = [Path(cache_folder_path, "{}.npy".format(tone)) for tone in tones]
+    # the anchor tone is the source itself so it is never transposed, workers
+    # write to the cache as they go so decide what is cached up front
+    is_cached = [
+        tone == 0 or cached_path.exists()
+        for tone, cached_path in zip(tones, cached_paths)
+    ]
+    uncached_tones = [tone for tone, cached in zip(tones, is_cached) if not cached]
+    uncached_paths = [
+        cached_path
+        for cached_path, cached in zip(cached_paths, is_cached)
+        if not cached
+    ]
+    transposed_sounds = iter(())
+    # a warm start has every note cached and never starts the pool
+    executor = contextlib.nullcontext()
+    if uncached_tones:
+        # the analysis stft is identical for every tone so compute it once,
+        # threaded over every core before the pool starts, then transpose and
+        # cache the tones in parallel since they are independent
+        librosa = import_librosa()
+        with scipy.fft.set_workers(-1):
+            stft = librosa.stft(y)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            initializer=init_transpose_worker,
+            initargs=(stft, sample_rate_hz, y.shape[-1], res_type),
+        )
+        transposed_sounds = executor.map(
+            transpose_and_cache_in_worker, uncached_tones, uncached_paths
+        )
+    with executor:
+        for i, (tone, cached_path) in enumerate(zip(tones, cached_paths)):
+            if is_cached[i]:
+                print(
+                    "Loading note {} out of {} for {}".format(
+                        i + 1, len(tones), keys[i]
+                    )
                 )
-            )
-            if channels == 1:
-                sound = librosa.effects.pitch_shift(y, sr, n_steps=tone)
+                if tone == 0:
+                    # the shape must be [length, channels]
+                    sound = to_pcm_16bit(y.T)
+                else:
+                    # cached notes are raw arrays already in the mixer's format
+                    # and layout, map them instead of decoding them
+                    sound = numpy.load(cached_path, mmap_mode="r")
             else:
-                new_channels = [
-                    librosa.effects.pitch_shift(y[i], sr, n_steps=tone)
-                    for i in range(channels)
-                ]
-                sound = numpy.ascontiguousarray(numpy.vstack(new_channels).T)
-            soundfile.write(cached_path, sound, sample_rate_hz, DESCRIPTOR_32BIT)
-        sounds.append(sound)
-    sounds = map(pygame.sndarray.make_sound, sounds)
-    return sounds
+                sound = next(transposed_sounds)
+                print(
+                    "Transposing note {} out of {} for {}".format(
+                        i + 1, len(tones), keys[i]
+                    )
+                )
+            sounds.append(sound)
+    # make_sound needs C-contiguous arrays in the mixer's 16 bit format, convert
+    # them now rather than through a hidden copy when the Sound is made
+    return [numpy.ascontiguousarray(sound, dtype=DTYPE_16BIT) for sound in sounds]
 
 
 BLACK_INDICES_C_SCALE = [1, 3, 6, 8, 10]
 LETTER_KEYS_TO_INDEX = {"c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+# an anchor note is a single note letter after a space or a tab
+ANCHOR_NOTE_SUFFIXES = frozenset(
+    separator + letter for separator in " \t" for letter in LETTER_KEYS_TO_INDEX
+)
 
 
 def __get_black_key_indices(key_name: str) -> set:
@@ -137,11 +322,10 @@ def get_keyboard_info(keyboard_file: str):
         line = line.strip()
         if not line:
             continue
-        match = ANCHOR_NOTE_REGEX.search(line)
-        if match:
+        if len(line) > 2 and line[-2:] in ANCHOR_NOTE_SUFFIXES:
             anchor_index = i
             black_key_indices = __get_black_key_indices(line[-1])
-            key = kl.Key(line[: match.start(0)])
+            key = kl.Key(line[:-2])
         elif line.endswith(ANCHOR_INDICATOR):
             anchor_index = i
             key = kl.Key(line[: -len(ANCHOR_INDICATOR)])
@@ -194,6 +378,7 @@ def configure_pygame_audio_and_set_ui(
     color_to_key: Dict[str, List[kl.Key]],
     key_color: Tuple[int, int, int, int],
     key_txt_color: Tuple[int, int, int, int],
+    buffer_samples: int = AUDIO_BUFFER_SAMPLES,
 ) -> Tuple[pygame.Surface, klp.KeyboardLayout]:
     # ui
     pygame.display.init()
@@ -209,8 +394,9 @@ def configure_pygame_audio_and_set_ui(
     # audio
     pygame.mixer.init(
         framerate_hz,
-        BITS_32BIT,
+        BITS_16BIT_SIGNED,
         channels,
+        buffer=buffer_samples,
         allowedchanges=AUDIO_ALLOWED_CHANGES_HARDWARE_DETERMINED,
     )
 
@@ -224,23 +410,27 @@ def configure_pygame_audio_and_set_ui(
         ValueError("keyboard must have qwerty or azerty in its name")
     margin = 4
     key_size = 60
+    # SysFont searches the system fonts, every key uses the same one so load it once
+    txt_font = pygame.font.SysFont("Arial", key_size // 4)
     overrides = {}
+    other_val = 255
+    other_txt_color = pygame.Color([other_val] * 3 + [255])
     for color_value, keys in color_to_key.items():
-        override_color = color = pygame.Color(color_value)
-        inverted_color = list(~override_color)
-        other_val = 255
+        override_color = pygame.Color(color_value)
+        inverted_color = ~override_color
         if (
             abs(color_value[0] - inverted_color[0]) > abs(color_value[0] - other_val)
         ) or color_value == CYAN:
-            override_txt_color = pygame.Color(inverted_color)
+            override_txt_color = inverted_color
         else:
-            # biases grey override keys to use white as txt_color
-            override_txt_color = pygame.Color([other_val] * 3 + [255])
+            # biases grey override keys to use white as txt_color, the Color is
+            # shared since it is the same for every bucket
+            override_txt_color = other_txt_color
         override_key_info = kl.KeyInfo(
             margin=margin,
             color=override_color,
             txt_color=override_txt_color,
-            txt_font=pygame.font.SysFont("Arial", key_size // 4),
+            txt_font=txt_font,
             txt_padding=(key_size // 10, key_size // 10),
         )
         for key in keys:
@@ -251,8 +441,8 @@ def configure_pygame_audio_and_set_ui(
     key_info = kl.KeyInfo(
         margin=margin,
         color=pygame.Color(key_color),
-        txt_color=pygame.Color(key_txt_color),
-        txt_font=pygame.font.SysFont("Arial", key_size // 4),
+        txt_color=key_txt_color,
+        txt_font=txt_font,
         txt_padding=(key_size // 6, key_size // 10),
     )
     letter_key_size = (key_size, key_size)  # width, height
@@ -275,45 +465,49 @@ def play_until_user_exits(
     key_sounds: List[pygame.mixer.Sound],
     keyboard: klp.KeyboardLayout,
 ):
-    sound_by_key = dict(zip(keys, key_sounds))
-    playing = True
-
-    while playing:
-        for event in pygame.event.get():
-
-            if event.type == pygame.QUIT:
-                playing = False
-                break
-            elif event.key == pygame.K_ESCAPE:
-                playing = False
-                break
-
-            key = keyboard.get_key(event)
-            if key is None:
-                continue
-            try:
-                sound = sound_by_key[key]
-            except KeyError:
-                continue
+    # each key gets its own channel, so a key press restarts only that key's note
+    # and never waits for or steals a free channel from another key
+    pygame.mixer.set_num_channels(len(keys))
+    voice_by_key = {
+        key: (sound, pygame.mixer.Channel(i))
+        for i, (key, sound) in enumerate(zip(keys, key_sounds))
+    }
+    # the layout maps a key code to the same key every time, so each code is
+    # looked up once and its voice, or None, is reused for later events
+    voice_by_keycode = {}
+
+    while True:
+        # block until the next event instead of polling an empty queue
+        event = pygame.event.wait()
+
+        if event.type == pygame.QUIT:
+            break
+        elif event.key == pygame.K_ESCAPE:
+            break
+
+        try:
+            voice = voice_by_keycode[event.key]
+        except KeyError:
+            voice = voice_by_key.get(keyboard.get_key(event))
+            voice_by_keycode[event.key] = voice
+        if voice is None:
+            continue
+        sound, channel = voice
 
-            if event.type == pygame.KEYDOWN:
-                sound.stop()
-                sound.play(fade_ms=SOUND_FADE_MILLISECONDS)
-            elif event.type == pygame.KEYUP:
-                sound.fadeout(SOUND_FADE_MILLISECONDS)
+        if event.type == pygame.KEYDOWN:
+            channel.play(sound, fade_ms=SOUND_FADE_MILLISECONDS)
+        elif event.type == pygame.KEYUP:
+            channel.fadeout(SOUND_FADE_MILLISECONDS)
 
     pygame.quit()
     print("Goodbye")
 
 
 def get_audio_data(wav_path: str) -> Tuple:
-    audio_data, framerate_hz = soundfile.read(wav_path)
-    array_shape = audio_data.shape
-    if len(array_shape) == 1:
-        channels = 1
-    else:
-        channels = array_shape[1]
-    return audio_data, framerate_hz, channels
+    # only the header is needed here, the samples are decoded once when the key
+    # sounds are made
+    info = soundfile.info(wav_path)
+    return info.samplerate, info.channels
 
 
 def process_args(parser: argparse.ArgumentParser, args: Optional[List]) -> Tuple:
@@ -333,22 +527,32 @@ def process_args(parser: argparse.ArgumentParser, args: Optional[List]) -> Tuple
     keyboard_path = args.keyboard
     if keyboard_path.startswith(KEYBOARD_ASSET_PREFIX):
         keyboard_path = os.path.join(CURRENT_WORKING_DIR, keyboard_path)
-    return wav_path, keyboard_path, args.clear_cache
+    res_type = FAST_RES_TYPE if args.fast_pitch else RES_TYPE
+    return wav_path, keyboard_path, args.clear_cache, res_type, args.buffer
 
 
 def play_pianoputer(args: Optional[List[str]] = None):
     parser = get_parser()
-    wav_path, keyboard_path, clear_cache = process_args(parser, args)
-    audio_data, framerate_hz, channels = get_audio_data(wav_path)
+    results = process_args(parser, args)
+    wav_path, keyboard_path, clear_cache, res_type, buffer_samples = results
+    framerate_hz, channels = get_audio_data(wav_path)
     results = get_keyboard_info(keyboard_path)
     keys, tones, color_to_key, key_color, key_txt_color = results
-    key_sounds = get_or_create_key_sounds(
-        wav_path, framerate_hz, channels, tones, clear_cache, keys
+    key_sound_arrays = get_or_create_key_sounds(
+        wav_path, framerate_hz, channels, tones, clear_cache, keys, res_type
     )
 
     _screen, keyboard = configure_pygame_audio_and_set_ui(
-        framerate_hz, channels, keyboard_path, color_to_key, key_color, key_txt_color
+        framerate_hz,
+        channels,
+        keyboard_path,
+        color_to_key,
+        key_color,
+        key_txt_color,
+        buffer_samples,
     )
+    # sounds can only be made once the mixer is initialized
+    key_sounds = [pygame.sndarray.make_sound(sound) for sound in key_sound_arrays]
     print(
         "Ready for you to play!\n"
         "Press the keys on your keyboard. "
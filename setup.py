@@ -8,7 +8,13 @@ with open(this_directory / "README.md", encoding="utf-8") as f:
 
 setup(
     name="pianoputer",
-    install_requires=["librosa >= 0.8.0", "pygame >= 2.0.0", "keyboardlayout >= 2.0.1"],
+    install_requires=[
+        "librosa >= 0.10.0",
+        "pygame >= 2.0.0",
+        "keyboardlayout >= 2.0.1",
+        "soxr",
+        "scipy >= 1.4",
+    ],
     python_requires=">=3",
     version="2.0.2",
     description='Use your computer keyboard as a "piano"',
@@ -1,19 +1,37 @@
+import concurrent.futures
 import os
 import shutil
+import tempfile
 import typing
 import unittest
+from pathlib import Path
 from unittest.mock import patch
 
+import numpy
 import pygame
 
 import pianoputer.pianoputer as pp
 
+TESTS_FOLDER = os.path.dirname(__file__)
+
+
+def get_quit():
+    return pygame.event.Event(pygame.QUIT)
+
+
+def play_until_quit(args: typing.List[str]):
+    with patch("pygame.event.wait", side_effect=get_quit):
+        pp.play_pianoputer(args)
+
 
 class PianoPuter(unittest.TestCase):
     sample_images_folder = "pianoputer/keyboards/"
+    audio_file_path = os.path.join(TESTS_FOLDER, "piano-c4_1channel.wav")
+    cache_root_path = os.path.join(TESTS_FOLDER, "piano-c4_1channel")
 
     def tearDown(self):
         pygame.quit()
+        shutil.rmtree(self.cache_root_path, ignore_errors=True)
 
     def test_works_with_different_channels(self):
         audio_files = [
@@ -21,25 +39,94 @@ class PianoPuter(unittest.TestCase):
             "piano-c4_2channel.wav",
             "piano-c4_4channel.wav",
         ]
-
-        def get_quit():
-            return [pygame.event.Event(pygame.QUIT)]
-
         for audio_file in audio_files:
-            with patch("pygame.event.get", side_effect=get_quit) as m_event_get:
-                audio_file_path = os.path.join(os.path.dirname(__file__), audio_file)
-                pp.play_pianoputer(["-w", audio_file_path])
+            play_until_quit(["-w", os.path.join(TESTS_FOLDER, audio_file)])
             file_name, file_extension = os.path.splitext(audio_file)
-            folder_path = os.path.join(os.path.dirname(__file__), file_name)
+            folder_path = os.path.join(TESTS_FOLDER, file_name)
             shutil.rmtree(folder_path)
 
+    def test_reuses_cached_notes(self):
+        play_until_quit(["-w", self.audio_file_path])
+        # the second run must load every note instead of transposing it
+        with patch("pianoputer.pianoputer.import_librosa") as import_librosa:
+            play_until_quit(["-w", self.audio_file_path])
+        import_librosa.assert_not_called()
+        (cache_folder,) = os.listdir(self.cache_root_path)
+        cached_notes = os.listdir(os.path.join(self.cache_root_path, cache_folder))
+        # every key but the anchor is cached
+        self.assertEqual(len(cached_notes), 42)
+
+    def test_interrupted_cache_write_leaves_no_note(self):
+        def save_partially(file, _array):
+            file.write(b"\x93NUMPY")
+            raise KeyboardInterrupt
+
+        stft = numpy.zeros((1025, 5), dtype=numpy.complex64)
+        with tempfile.TemporaryDirectory() as folder_path:
+            cached_path = Path(folder_path, "1.npy")
+            with patch("numpy.save", side_effect=save_partially):
+                with self.assertRaises(KeyboardInterrupt):
+                    pp.transpose_and_cache(
+                        stft, 44100, 2048, pp.RES_TYPE, 1, cached_path
+                    )
+            self.assertEqual(os.listdir(folder_path), [])
+
+    def test_removes_wav_notes_cached_by_older_versions(self):
+        os.makedirs(self.cache_root_path)
+        old_cached_paths = [
+            os.path.join(self.cache_root_path, "{}.wav".format(tone))
+            for tone in (-3, 1)
+        ]
+        user_wav_path = os.path.join(self.cache_root_path, "piano-c5.wav")
+        for wav_path in old_cached_paths + [user_wav_path]:
+            shutil.copyfile(self.audio_file_path, wav_path)
+        play_until_quit(["-w", self.audio_file_path])
+        for old_cached_path in old_cached_paths:
+            self.assertFalse(os.path.exists(old_cached_path))
+        # wav files that were not cached notes are kept
+        self.assertTrue(os.path.exists(user_wav_path))
+
+    def test_removes_notes_cached_for_earlier_wav_contents(self):
+        framerate_hz, channels = pp.get_audio_data(self.audio_file_path)
+        stale_folder_path, fast_folder_path = [
+            os.path.join(
+                self.cache_root_path,
+                "{}-{}-{}-int16-earlier".format(framerate_hz, channels, res_type),
+            )
+            for res_type in (pp.RES_TYPE, pp.FAST_RES_TYPE)
+        ]
+        os.makedirs(stale_folder_path)
+        os.makedirs(fast_folder_path)
+        play_until_quit(["-w", self.audio_file_path])
+        self.assertFalse(os.path.exists(stale_folder_path))
+        # notes cached with the other resampler are still valid
+        self.assertTrue(os.path.exists(fast_folder_path))
+        self.assertEqual(len(os.listdir(self.cache_root_path)), 2)
+
+    def test_fast_pitch_resamples_with_fast_resampler(self):
+        librosa = pp.import_librosa()
+        # transpose in threads so that librosa.resample can be watched
+        with patch(
+            "concurrent.futures.ProcessPoolExecutor",
+            concurrent.futures.ThreadPoolExecutor,
+        ), patch.object(librosa, "resample", wraps=librosa.resample) as resample:
+            play_until_quit(["-f", "-w", self.audio_file_path])
+        res_types = {call.kwargs["res_type"] for call in resample.call_args_list}
+        self.assertEqual(res_types, {pp.FAST_RES_TYPE})
+
+    def test_buffer_sets_audio_buffer_size(self):
+        with patch("pygame.mixer.init", wraps=pygame.mixer.init) as mixer_init:
+            play_until_quit(["-b", "1024", "-w", self.audio_file_path])
+        self.assertEqual(mixer_init.call_args.kwargs["buffer"], 1024)
+
     def test_writes_sample_keyboards_to_images(self):
         keyboards = ["keyboards/azerty_typewriter.txt", "keyboards/qwerty_piano.txt"]
         for keyboard in keyboards:
             parser = pp.get_parser()
             args = ["-k", keyboard]
-            wav_path, keyboard_path, clear_cache = pp.process_args(parser, args)
-            audio_data, framerate_hz, channels = pp.get_audio_data(wav_path)
+            results = pp.process_args(parser, args)
+            wav_path, keyboard_path, clear_cache, res_type, buffer_samples = results
+            framerate_hz, channels = pp.get_audio_data(wav_path)
             results = pp.get_keyboard_info(keyboard_path)
             _keys, _tones, color_name_to_key, key_color, key_txt_color = results
 